@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 import argparse
+import errno
 import fnmatch
+import functools
+import mmap
 import os
+import re
 import shutil
+import struct
 import subprocess
 import sys
 
-from elftools.elf.elffile import ELFFile
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 
 __appname__ = 'copydeps'
@@ -21,11 +27,54 @@ Can be used to inspect the dependencies of an executable through the generated
 dependency graph.
 """
 
-# Skip Linux dynamic loaders by default because they do not fit in the
-# soname => path output of ldd
+# Skip Linux dynamic loaders by default: the kernel loads them from the path
+# hardcoded in the executable, so copying them is pointless
 DEFAULT_EXCLUDE_LIST = ['ld-linux.so.*', 'ld-linux-x86-64.so.*']
 
-DOT_EXCLUDED_ATTRS = '[color="gray" fontcolor="gray"]'
+# Dirs searched by the dynamic linker after the ones listed in
+# LD_LIBRARY_PATH, DT_RPATH, DT_RUNPATH and its cache
+DEFAULT_LIBRARY_DIRS = ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
+
+# os.copy_file_range() fails with one of these when the kernel or the file
+# systems do not support it
+COPY_FILE_RANGE_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                      errno.EOPNOTSUPP)
+
+# Matches the library lines of `ldconfig -p` output, which look like this:
+#   libz.so.1 (libc6,x86-64) => /lib/x86_64-linux-gnu/libz.so.1
+# The first line, "N libs found in cache", is skipped
+LDCONFIG_LINE_RE = re.compile(rb'^\s*(\S+)\s+\([^)]*\)\s+=>\s+(.+)$', re.M)
+
+# os.link() fails with one of these when the file system does not support
+# hard links, when the link count limit is reached or when the kernel
+# protects the file against hard links
+LINK_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EMLINK, errno.EPERM,
+                           errno.EOPNOTSUPP)
+
+DOT_EXCLUDED_ATTRS = b'[color="gray" fontcolor="gray"]'
+
+ELF_MAGIC = b'\x7fELF'
+EI_CLASS = 4
+EI_DATA = 5
+E_MACHINE_OFFSET = 18
+ELF_BYTE_ORDERS = {1: '<', 2: '>'}
+# EI_CLASS => (ELF header, program header fields, dynamic entry) struct
+# formats. Program header formats only extract p_type, p_offset, p_vaddr and
+# p_filesz
+ELF_STRUCTS = {
+    1: ('16sHHIIIIIHHHHHH', 'III4xI', 'iI'),
+    2: ('16sHHIQQQIHHHHHH', 'I4xQQ8xQ', 'qQ'),
+}
+PT_LOAD = 1
+PT_DYNAMIC = 2
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+Dependencies = namedtuple('Dependencies',
+                          ('arch', 'sonames', 'rpath', 'runpath'))
 
 
 class MissingLibrariesError(Exception):
@@ -33,6 +82,10 @@ class MissingLibrariesError(Exception):
         self.libs = libs
 
 
+class InvalidELFFileError(Exception):
+    pass
+
+
 def printerr(*args, **kwargs):
     kwargs['file'] = sys.stderr
     print(*args, **kwargs)
@@ -47,129 +100,437 @@ def load_exclude_list(filename):
             yield line
 
 
-def list_soname_paths(executable):
-    """Return a dict of the form soname => path for all the dependency of
-    the executable"""
-    out = subprocess.check_output(('ldd', executable))
-    return parse_ldd_output(out)
+def parse_ldconfig_output(ldconfig_output):
+    """Return a dict of the form soname => [path, ...] from the output of
+    `ldconfig -p`"""
+    dct = {}
+    for match in LDCONFIG_LINE_RE.finditer(ldconfig_output):
+        soname, path = match.groups()
+        dct.setdefault(os.fsdecode(soname), []).append(os.fsdecode(path))
+    return dct
 
 
-def parse_ldd_output(ldd_output):
-    """Return a dict of the form soname => path"""
-    dct = {}
-    missing_libs = []
-    for line in ldd_output.splitlines():
-        line = line.strip().decode('ascii')
-        # line can be one of:
-        # 1. linux-vdso.so.1 =>  (0x00007ffd6f3cd000)
-        # 2. libcrypto.so.1.0.0 => /home/agateau/tmp/genymotion/./libcrypto.so.1.0.0 (0x00007f5ea40b6000)
-        # 3. /lib64/ld-linux-x86-64.so.2 (0x0000562cf1094000)
-
-        if not line:
-            continue
-        if '=>  (' in line:
-            # Format #1, skip it
-            continue
-        if '=>' in line:
-            # Format #2
-            tokens = line.split(' ', 3)
-            assert tokens[1] == '=>', 'Unexpected line format: {}'.format(line)
+def load_ldcache():
+    """Return a dict of the form soname => [path, ...] for all the libraries
+    known to the dynamic linker cache"""
+    ldconfig = shutil.which('ldconfig') or '/sbin/ldconfig'
+    try:
+        out = subprocess.check_output((ldconfig, '-p'))
+    except (OSError, subprocess.CalledProcessError) as exc:
+        # Libraries can still be found in DEFAULT_LIBRARY_DIRS
+        printerr('Warning: failed to load the ldconfig cache: {}'.format(exc))
+        return {}
+    return parse_ldconfig_output(out)
 
-            soname = tokens[0]
 
-            # Handle the case where a library has not been found
-            if tokens[2:4] == ['not', 'found']:
-                missing_libs.append(soname)
+def get_elf_arch(path):
+    """Return a tuple identifying the architecture of the ELF file at path, or
+    None if it is not an ELF file"""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(E_MACHINE_OFFSET + 2)
+        return parse_elf_arch(header)
+    except (IOError, InvalidELFFileError):
+        return None
+
+
+def parse_elf_arch(data):
+    """Return a (class, little_endian, machine) tuple for the ELF file whose
+    content starts with data"""
+    if data[:4] != ELF_MAGIC:
+        raise InvalidELFFileError('not an ELF file')
+    if len(data) < E_MACHINE_OFFSET + 2:
+        raise InvalidELFFileError('truncated ELF header')
+    if (data[EI_CLASS] not in ELF_STRUCTS or
+            data[EI_DATA] not in ELF_BYTE_ORDERS):
+        raise InvalidELFFileError('unsupported ELF class or data encoding')
+    byte_order = ELF_BYTE_ORDERS[data[EI_DATA]]
+    try:
+        machine, = struct.unpack_from(byte_order + 'H', data, E_MACHINE_OFFSET)
+    except struct.error:
+        raise InvalidELFFileError('truncated ELF header')
+    return (data[EI_CLASS] * 32, byte_order == '<', machine)
 
-            path = tokens[2]
-        else:
-            # Format #3, set path to the soname
-            soname = line.split(' ')[0]
-            path = soname
 
-        dct[soname] = path
-    if missing_libs:
-        raise MissingLibrariesError(missing_libs)
-    return dct
+def parse_dynamic_section(data):
+    """Return a Dependencies tuple for the ELF file whose content is data.
+
+    Only reads the ELF header, the program headers and the PT_DYNAMIC
+    segment: section headers are not needed to find DT_NEEDED entries."""
+    arch = parse_elf_arch(data)
+    elfclass, little_endian, _ = arch
+    byte_order = '<' if little_endian else '>'
+    ehdr_fmt, phdr_fmt, dyn_fmt = (byte_order + x
+                                   for x in ELF_STRUCTS[elfclass // 32])
+
+    try:
+        ehdr = struct.unpack_from(ehdr_fmt, data)
+        phoff, phentsize, phnum = ehdr[5], ehdr[9], ehdr[10]
+
+        loads = []
+        dynamic = None
+        for idx in range(phnum):
+            p_type, p_offset, p_vaddr, p_filesz = struct.unpack_from(
+                phdr_fmt, data, phoff + idx * phentsize)
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+        if dynamic is None:
+            # Statically linked
+            return Dependencies(arch, (), (), ())
+
+        needed = []
+        rpath = []
+        runpath = []
+        strtab_vaddr = None
+        offset, size = dynamic
+        size -= size % struct.calcsize(dyn_fmt)
+        entries = data[offset:offset + size]
+        for tag, value in struct.iter_unpack(dyn_fmt, entries):
+            # The segment often contains spare DT_NULL entries after the one
+            # terminating the array, do not iterate over them
+            if tag == DT_NULL:
+                break
+            if tag == DT_NEEDED:
+                needed.append(value)
+            elif tag == DT_RPATH:
+                rpath.append(value)
+            elif tag == DT_RUNPATH:
+                runpath.append(value)
+            elif tag == DT_STRTAB:
+                strtab_vaddr = value
+    except struct.error as exc:
+        raise InvalidELFFileError('truncated ELF file ({})'.format(exc))
+
+    if not (needed or rpath or runpath):
+        return Dependencies(arch, (), (), ())
+    if strtab_vaddr is None:
+        raise InvalidELFFileError('no DT_STRTAB entry')
+    strtab = _vaddr_to_offset(loads, strtab_vaddr)
+
+    def read_string(offset):
+        start = strtab + offset
+        end = data.find(b'\0', start)
+        if end == -1:
+            raise InvalidELFFileError('unterminated string in DT_STRTAB')
+        return os.fsdecode(data[start:end])
+
+    return Dependencies(
+        arch,
+        tuple(read_string(x) for x in needed),
+        tuple(y for x in rpath for y in read_string(x).split(':')),
+        tuple(y for x in runpath for y in read_string(x).split(':')))
+
+
+def _vaddr_to_offset(loads, vaddr):
+    for p_vaddr, p_offset, p_filesz in loads:
+        if p_vaddr <= vaddr < p_vaddr + p_filesz:
+            return vaddr - p_vaddr + p_offset
+    raise InvalidELFFileError('address {:#x} is not in a PT_LOAD segment'
+                              .format(vaddr))
 
 
 def list_dependencies(binary):
-    """Return the list of sonames this binary *directly* depends on"""
-    with open(binary, 'rb') as f:
-        elf = ELFFile(f)
-        section = elf.get_section_by_name('.dynamic')
-        if section is None:
-            return
-        for tag in section.iter_tags():
-            if tag.entry.d_tag == 'DT_NEEDED':
-                yield tag.needed
+    """Return the sonames this binary *directly* depends on, together with
+    the library dirs listed in its DT_RPATH and DT_RUNPATH tags"""
+    st = os.stat(binary)
+    return _read_dependencies(os.path.realpath(binary), st.st_mtime_ns,
+                              st.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_dependencies(path, mtime_ns, size):
+    # mtime_ns and size are not used, they are only here to invalidate the
+    # cache if the file changes
+    if size == 0:
+        raise InvalidELFFileError('{}: empty file'.format(path))
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as data:
+            try:
+                return parse_dynamic_section(data)
+            except InvalidELFFileError as exc:
+                raise InvalidELFFileError('{}: {}'.format(path, exc))
+
+
+def expand_origin(dirs, binary_path):
+    """Replace $ORIGIN in dirs with the dir containing binary_path, skip empty
+    entries"""
+    origin = os.path.dirname(os.path.abspath(binary_path))
+    for dir in dirs:
+        if not dir:
+            continue
+        yield dir.replace('${ORIGIN}', origin).replace('$ORIGIN', origin)
+
+
+def compile_exclude_list(exclude_list):
+    """Return a regular expression matching all the patterns of
+    exclude_list"""
+    if not exclude_list:
+        # An empty regular expression would match everything
+        return re.compile(r'(?!)')
+    return re.compile('|'.join('(?:{})'.format(fnmatch.translate(x))
+                               for x in exclude_list))
+
+
+_DEFAULT_EXCLUDE_RE = compile_exclude_list(DEFAULT_EXCLUDE_LIST)
+
+
+def is_excluded(soname, exclude_re):
+    """Return True if soname matches DEFAULT_EXCLUDE_LIST or exclude_re"""
+    # DT_NEEDED entries are almost always bare sonames, only get the basename
+    # of the ones which are paths
+    if '/' in soname:
+        soname = os.path.basename(soname)
+    if _DEFAULT_EXCLUDE_RE.match(soname):
+        return True
+    return exclude_re.match(soname) is not None
+
+
+def copy_file(src, dst):
+    """Copy the content of src to dst. The copy happens inside the kernel
+    when possible"""
+    if hasattr(os, 'copy_file_range'):
+        with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+            size = os.fstat(src_fp.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    copied = os.copy_file_range(src_fp.fileno(),
+                                                dst_fp.fileno(), size - offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            except OSError as exc:
+                if exc.errno not in COPY_FILE_RANGE_UNSUPPORTED_ERRNOS:
+                    raise
+            if offset == size:
+                return
+    # Fall back to shutil, which uses sendfile() when available
+    shutil.copyfile(src, dst)
+
+
+def prefetch(paths):
+    """Ask the kernel to start reading the files at paths in the
+    background"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # copy() reports the error
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
 
 
-def is_excluded(dependency, exclude_list):
-    name = os.path.basename(dependency)
-    for pattern in exclude_list:
-        if fnmatch.fnmatch(name, pattern):
-            return True
-    return False
+def copy(dependency, destpath, hardlink=False):
+    if hardlink:
+        try:
+            # Libraries from the ldconfig cache are usually symlinks, and
+            # os.link() does not follow them on Linux
+            os.link(os.path.realpath(dependency), destpath)
+            print('Linking {} to {}'.format(dependency, destpath))
+            return
+        except OSError as exc:
+            if exc.errno not in LINK_UNSUPPORTED_ERRNOS:
+                raise
+    print('Copying {} to {}'.format(dependency, destpath))
+    copy_file(dependency, destpath)
+    shutil.copymode(dependency, destpath)
 
 
-def copy(dependency, destdir):
-    destpath = os.path.join(destdir, os.path.basename(dependency))
-    if not os.path.exists(destpath):
-        print('Copying {} to {}'.format(dependency, destpath))
-        shutil.copy(dependency, destpath)
+def copy_all(copy_list, hardlink=False):
+    for src, dst in copy_list:
+        copy(src, dst, hardlink=hardlink)
 
 
 class App:
-    def __init__(self, exclude_list, destdir, dry_run, dot_fp=None):
+    __slots__ = ('path_for_binary', 'destdir', 'dry_run', 'hardlink',
+                 'exclude_list', '_exclude_re', 'processed_sonames',
+                 'missing_libs', 'dot_fp', '_graph_dependency',
+                 '_graph_excluded_dependency', '_dot_buf', 'ldcache',
+                 'ld_library_path', 'executable_rpath', '_destdir_contents')
+
+    def __init__(self, exclude_list, destdir, dry_run, dot_fp=None,
+                 hardlink=False):
+        """exclude_list contains the patterns to exclude in addition to
+        DEFAULT_EXCLUDE_LIST"""
         self.path_for_binary = {}
         self.destdir = destdir
         self.dry_run = dry_run
+        self.hardlink = hardlink
         self.exclude_list = exclude_list
+        self._exclude_re = compile_exclude_list(exclude_list)
         self.processed_sonames = set()
+        self.missing_libs = []
         self.dot_fp = dot_fp
-
-    def run(self, binary_path):
-        if self.dot_fp:
-            self.dot_fp.write('digraph {\n')
-        binary = os.path.basename(binary_path)
-        self.path_for_binary = list_soname_paths(binary_path)
-        self.path_for_binary[binary] = binary_path
-        self._traverse_tree(binary)
-        if self.dot_fp:
-            self.dot_fp.write('}\n')
-
-    def _traverse_tree(self, binary):
-        path = self.path_for_binary[binary]
-        sonames = list_dependencies(path)
-        for soname in sonames:
-            if is_excluded(soname, self.exclude_list):
-                if self.dot_fp:
-                    self._graph_excluded_dependency(binary, soname)
-                else:
-                    printerr("Skipping {}".format(soname))
+        # Select the graph functions once, instead of checking dot_fp for
+        # each dependency
+        if dot_fp is None:
+            self._graph_dependency = lambda *args: None
+            self._graph_excluded_dependency = self._print_excluded_dependency
+        else:
+            self._graph_dependency = self._dot_dependency
+            self._graph_excluded_dependency = self._dot_excluded_dependency
+        self._dot_buf = []
+        self.ldcache = None
+        self.ld_library_path = []
+        self.executable_rpath = []
+        # Names of the files in destdir, to skip libraries which are already
+        # there without calling stat() for each of them
+        self._destdir_contents = set()
+        if os.path.isdir(destdir or os.curdir):
+            self._destdir_contents = set(os.listdir(destdir or os.curdir))
+
+    def run(self, binary_path, binary):
+        """Process the binary at binary_path. binary is the name of the
+        binary, used in the graph"""
+        self._dot_buf = [b'digraph {\n']
+        self.path_for_binary = {binary: binary_path}
+        self.ld_library_path = [
+            x for x in os.environ.get('LD_LIBRARY_PATH', '').split(':') if x]
+        deps = list_dependencies(binary_path)
+        if not deps.runpath:
+            # Unless a library has a DT_RUNPATH, the dynamic linker also looks
+            # for its dependencies in the DT_RPATH of the executable
+            self.executable_rpath = list(expand_origin(deps.rpath,
+                                                       binary_path))
+        # Parsing and copying libraries is I/O bound, so use more threads
+        # than CPUs
+        max_workers = (os.cpu_count() or 1) * 2
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            copy_list = self._traverse_tree(binary, executor)
+            if self.dot_fp:
+                self._dot_buf.append(b'}\n')
+                self.dot_fp.write(b''.join(self._dot_buf))
+            if self.missing_libs:
+                raise MissingLibrariesError(self.missing_libs)
+            if not self.dry_run:
+                self._copy_libraries(copy_list, executor)
+
+    def _traverse_tree(self, root, executor):
+        """Walk the dependency tree of root. Return a list of (source,
+        destination name) tuples for the libraries to copy"""
+        copy_list = []
+        level = [root]
+        while level:
+            paths = [self.path_for_binary[x] for x in level]
+            deps_list = executor.map(list_dependencies, paths)
+            next_level = []
+            for binary, binary_path, deps in zip(level, paths, deps_list):
+                next_level.extend(
+                    self._process_dependencies(binary, binary_path, deps))
+
+            for soname in next_level:
+                path = self.path_for_binary[soname]
+                if self.dry_run:
+                    printerr("Would copy {} to {}".format(path, self.destdir))
+                copy_list.append((path, os.path.basename(path)))
+            level = next_level
+        return copy_list
+
+    def _copy_libraries(self, copy_list, executor):
+        to_copy = []
+        for src, name in copy_list:
+            if name in self._destdir_contents:
+                continue
+            self._destdir_contents.add(name)
+            to_copy.append((src, os.path.join(self.destdir, name)))
+
+        # Let the kernel read all the libraries in the background while we
+        # copy them
+        prefetch(src for src, _ in to_copy)
+
+        # Copies between the same devices are done one after the other to
+        # keep I/O sequential, copies involving different devices run in
+        # parallel. destdir is the same for all libraries, so in practice
+        # libraries are grouped by source device.
+        dest_dev = os.stat(self.destdir or os.curdir).st_dev
+        groups = defaultdict(list)
+        for src, dst in to_copy:
+            groups[(os.stat(src).st_dev, dest_dev)].append((src, dst))
+        copies = []
+        for (src_dev, dst_dev), group in groups.items():
+            hardlink = self.hardlink and src_dev == dst_dev
+            copies.append(executor.submit(copy_all, group, hardlink))
+        # Raise copy errors, if any
+        for future in copies:
+            future.result()
+
+    def _process_dependencies(self, binary, binary_path, deps):
+        """Find the dependencies of binary. Return the list of sonames which
+        have not been processed yet"""
+        sonames = []
+        for soname in deps.sonames:
+            if is_excluded(soname, self._exclude_re):
+                self._graph_excluded_dependency(binary, soname)
                 continue
 
-            if self.dot_fp:
-                self._graph_dependency(binary, soname)
+            self._graph_dependency(binary, soname)
 
             if soname in self.processed_sonames:
                 continue
             self.processed_sonames.add(soname)
-            path = self.path_for_binary[soname]
-            if self.dry_run:
-                printerr("Would copy {} to {}".format(path, self.destdir))
-            else:
-                copy(path, self.destdir)
-            self._traverse_tree(soname)
-
-    def _graph_excluded_dependency(self, binary, soname):
-        self.dot_fp.write('  "{}" {};\n'.format(soname, DOT_EXCLUDED_ATTRS))
-        self.dot_fp.write('  "{}" -> "{}" {};\n'
-                          .format(binary, soname, DOT_EXCLUDED_ATTRS))
-
-    def _graph_dependency(self, binary, soname):
-        self.dot_fp.write('  "{}" -> "{}";\n'.format(binary, soname))
+            path = self._find_library(soname, binary_path, deps)
+            if path is None:
+                self.missing_libs.append(soname)
+                continue
+            self.path_for_binary[soname] = path
+            sonames.append(soname)
+        return sonames
+
+    def _find_library(self, soname, binary_path, deps):
+        """Return the path the dynamic linker would load soname from when
+        loading binary_path, or None if it cannot be found"""
+        if '/' in soname:
+            # Not a soname but a path, relative to the current dir
+            return soname if os.path.isfile(soname) else None
+
+        for candidate in self._list_candidates(soname, binary_path, deps):
+            # Skip libraries built for another architecture, as the dynamic
+            # linker does
+            if get_elf_arch(candidate) == deps.arch:
+                return candidate
+        return None
+
+    def _list_candidates(self, soname, binary_path, deps):
+        """Yield the paths where the dynamic linker would look for soname, in
+        order"""
+        dirs = []
+        if not deps.runpath:
+            dirs.extend(expand_origin(deps.rpath, binary_path))
+            dirs.extend(self.executable_rpath)
+        dirs.extend(self.ld_library_path)
+        dirs.extend(expand_origin(deps.runpath, binary_path))
+        for dir in dirs:
+            yield os.path.join(dir, soname)
+
+        # Only run ldconfig if a library cannot be found in the dirs above,
+        # which is often the case for self-contained applications
+        if self.ldcache is None:
+            self.ldcache = load_ldcache()
+        yield from self.ldcache.get(soname, [])
+
+        for dir in DEFAULT_LIBRARY_DIRS:
+            yield os.path.join(dir, soname)
+
+    def _print_excluded_dependency(self, binary, soname):
+        printerr("Skipping {}".format(soname))
+
+    def _dot_excluded_dependency(self, binary, soname):
+        soname = os.fsencode(soname)
+        self._dot_buf.append(b'  "%s" %s;\n' % (soname, DOT_EXCLUDED_ATTRS))
+        binary = os.fsencode(binary)
+        self._dot_buf.append(b'  "%s" -> "%s" %s;\n'
+                             % (binary, soname, DOT_EXCLUDED_ATTRS))
+
+    def _dot_dependency(self, binary, soname):
+        self._dot_buf.append(b'  "%s" -> "%s";\n'
+                             % (os.fsencode(binary), os.fsencode(soname)))
 
 
 def main():
@@ -187,6 +548,12 @@ def main():
     parser.add_argument(
         '-n', '--dry-run', action='store_true', help='Simulate')
 
+    parser.add_argument(
+        '--hardlink', action='store_true',
+        help='Create hard links instead of copies for libraries stored on the'
+             ' same file system as DESTDIR. The links share their content'
+             ' with the original libraries: do not modify them')
+
     parser.add_argument(
         '--dot', metavar='FILE',
         help='Create a graphviz graph of the dependencies in FILE')
@@ -195,11 +562,11 @@ def main():
 
     args = parser.parse_args()
 
-    exclude_list = DEFAULT_EXCLUDE_LIST
+    exclude_list = []
     if args.exclude:
         if not os.path.isfile(args.exclude):
             parser.error('"{}" is not a file'.format(args.exclude))
-        exclude_list.extend(load_exclude_list(args.exclude))
+        exclude_list = list(load_exclude_list(args.exclude))
 
     if args.destdir and not os.path.isdir(args.destdir):
         parser.error('"{}" is not a directory'.format(args.destdir))
@@ -216,21 +583,24 @@ def main():
     dot_fp = None
     if args.dot:
         try:
-            dot_fp = open(args.dot, 'w')
+            dot_fp = open(args.dot, 'wb')
         except IOError as exc:
             parser.error('Failed to write to "{}": {}'.format(args.dot, exc))
 
     exit_code = 0
     app = App(exclude_list=exclude_list, destdir=destdir, dry_run=args.dry_run,
-              dot_fp=dot_fp)
+              dot_fp=dot_fp, hardlink=args.hardlink)
     try:
-        app.run(args.executable)
+        # The dynamic linker expands $ORIGIN using the real path of the
+        # executable
+        app.run(os.path.realpath(args.executable),
+                os.path.basename(args.executable))
     except MissingLibrariesError as exc:
         printerr('Error, missing libraries:')
         for lib in exc.libs:
             printerr('- {}'.format(lib))
         exit_code = 1
-    except IOError as exc:
+    except (IOError, InvalidELFFileError) as exc:
         printerr(exc)
         exit_code = 1
 
@@ -1,25 +1,297 @@
+# vi: ts=4 sw=4 et
+import errno
+import os
+import struct
+import subprocess
+
 import pytest
 
-from copydeps import parse_ldd_output, MissingLibrariesError
+import copydeps
+
+from copydeps import (compile_exclude_list, copy, copy_file, is_excluded,
+                      parse_dynamic_section, parse_elf_arch,
+                      parse_ldconfig_output, App, InvalidELFFileError,
+                      MissingLibrariesError)
+
+VADDR = 0x400000
+EM_X86_64 = 62
+
+
+def create_elf64(dynamic_entries, strings):
+    """Return the content of a minimal little-endian ELF64 file, with a
+    PT_DYNAMIC segment made of dynamic_entries, (tag, value) tuples.
+
+    DT_STRTAB and DT_NULL entries are added automatically. The values of
+    DT_NEEDED, DT_RPATH and DT_RUNPATH entries are indexes in strings."""
+    ehdr_size = 64
+    phdr_size = 56
+    strtab = b'\0' + b''.join(x.encode() + b'\0' for x in strings)
+    string_offsets = [1]
+    for string in strings[:-1]:
+        string_offsets.append(string_offsets[-1] + len(string) + 1)
+
+    strtab_offset = ehdr_size + 2 * phdr_size
+    dynamic_offset = strtab_offset + len(strtab)
+    entries = [(5, VADDR + strtab_offset)]
+    entries += [(tag, string_offsets[idx]) for tag, idx in dynamic_entries]
+    entries.append((0, 0))
+    dynamic = b''.join(struct.pack('<qQ', *x) for x in entries)
+    file_size = dynamic_offset + len(dynamic)
 
+    ehdr = struct.pack('<16sHHIQQQIHHHHHH', b'\x7fELF\x02\x01\x01', 3,
+                       EM_X86_64, 1, 0, ehdr_size, 0, 0, ehdr_size,
+                       phdr_size, 2, 0, 0, 0)
+    load = struct.pack('<IIQQQQQQ', 1, 5, 0, VADDR, VADDR, file_size,
+                       file_size, 0x1000)
+    dynamic_vaddr = VADDR + dynamic_offset
+    dyn = struct.pack('<IIQQQQQQ', 2, 6, dynamic_offset, dynamic_vaddr,
+                      dynamic_vaddr, len(dynamic), len(dynamic), 8)
+    return ehdr + load + dyn + strtab + dynamic
 
-def test_parse_ldd_output():
-    LDD_OUTPUT = b"""linux-vdso.so.1 =>  (0x00007ffd6f3cd000)
-    libcrypto.so.1.0.0 => /home/ci/build/genymotion/./libcrypto.so.1.0.0 (0x00007f5ea40b6000)
-    ./libfoo.so.2 (0x0000562cf1094000)
-    """
-    dct = parse_ldd_output(LDD_OUTPUT)
+
+def write_elf64(path, needed=(), rpath=None, runpath=None):
+    """Create a minimal ELF64 file at path, path being a pathlib.Path"""
+    strings = list(needed)
+    entries = [(1, idx) for idx in range(len(needed))]
+    for tag, value in (15, rpath), (29, runpath):
+        if value is not None:
+            entries.append((tag, len(strings)))
+            strings.append(value)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(create_elf64(entries, strings))
+
+
+def run_app(executable, monkeypatch, ld_library_path=''):
+    """Run App in dry-run mode on executable, without using the ldconfig
+    cache. Return the soname => path dict of the found libraries"""
+    monkeypatch.setenv('LD_LIBRARY_PATH', ld_library_path)
+    app = App(exclude_list=[], destdir=str(executable.parent), dry_run=True)
+    app.ldcache = {}
+    app.run(str(executable), executable.name)
+    return app.path_for_binary
+
+
+def test_parse_ldconfig_output():
+    LDCONFIG_OUTPUT = (
+        b"772 libs found in cache `/etc/ld.so.cache'\n"
+        b"\tlibz.so.1 (libc6,x86-64) => /lib/x86_64-linux-gnu/libz.so.1\n"
+        b"\tlibz.so.1 (libc6) => /lib/i386-linux-gnu/libz.so.1\n"
+        b"\tlibc.so.6 (libc6,x86-64, OS ABI: Linux 3.2.0)"
+        b" => /lib/x86_64-linux-gnu/libc.so.6\n")
+    dct = parse_ldconfig_output(LDCONFIG_OUTPUT)
     assert dct == {
-        'libcrypto.so.1.0.0': '/home/ci/build/genymotion/./libcrypto.so.1.0.0',
-        './libfoo.so.2': './libfoo.so.2',
+        'libz.so.1': [
+            '/lib/x86_64-linux-gnu/libz.so.1',
+            '/lib/i386-linux-gnu/libz.so.1',
+        ],
+        'libc.so.6': ['/lib/x86_64-linux-gnu/libc.so.6'],
     }
 
 
-def test_parse_ldd_output_library_not_found():
-    LDD_OUTPUT = b"""linux-vdso.so.1 =>  (0x00007ffd6f3cd000)
-    libstdc++.so.5 => not found
-    libbar.so.2 => not found
-    """
+def test_is_excluded():
+    exclude_re = compile_exclude_list(['libc.so.*', 'libQt5*.so.5'])
+    assert is_excluded('libc.so.6', exclude_re)
+    assert is_excluded('libQt5Core.so.5', exclude_re)
+    assert is_excluded('./libc.so.6', exclude_re)
+    assert not is_excluded('libcrypto.so.1.0.0', exclude_re)
+    assert not is_excluded('libQt5Core.so.5.15', exclude_re)
+
+
+def test_is_excluded_empty_list():
+    exclude_re = compile_exclude_list([])
+    assert not is_excluded('libc.so.6', exclude_re)
+    # DEFAULT_EXCLUDE_LIST is always applied
+    assert is_excluded('ld-linux-x86-64.so.2', exclude_re)
+
+
+def test_parse_dynamic_section():
+    data = create_elf64(
+        [(1, 0), (1, 1), (29, 2)],
+        ['libfoo.so.1', 'libbar.so.2', '$ORIGIN/../lib:/opt/lib'])
+    deps = parse_dynamic_section(data)
+    assert deps.arch == (64, True, EM_X86_64)
+    assert deps.sonames == ('libfoo.so.1', 'libbar.so.2')
+    assert deps.rpath == ()
+    assert deps.runpath == ('$ORIGIN/../lib', '/opt/lib')
+
+
+def test_parse_dynamic_section_stops_at_dt_null():
+    data = create_elf64([(1, 0), (0, 0), (1, 1)],
+                        ['libfoo.so.1', 'libbar.so.2'])
+    deps = parse_dynamic_section(data)
+    assert deps.sonames == ('libfoo.so.1',)
+
+
+def test_parse_dynamic_section_not_elf():
+    with pytest.raises(InvalidELFFileError):
+        parse_dynamic_section(b'#!/bin/sh\n')
+
+
+def test_parse_dynamic_section_truncated_header():
+    with pytest.raises(InvalidELFFileError):
+        parse_dynamic_section(b'\x7fELF')
+
+
+def test_parse_elf_arch():
+    # ELF32, big-endian, EM_MIPS
+    header = b'\x7fELF\x01\x02\x01' + b'\0' * 9 + b'\x00\x02\x00\x08'
+    assert parse_elf_arch(header) == (32, False, 8)
+
+
+def test_find_library_origin(tmp_path, monkeypatch):
+    write_elf64(tmp_path / 'bin' / 'app', needed=['libfoo.so.1'],
+                runpath='$ORIGIN/../lib')
+    write_elf64(tmp_path / 'lib' / 'libfoo.so.1')
+    paths = run_app(tmp_path / 'bin' / 'app', monkeypatch)
+    assert paths['libfoo.so.1'] == str(tmp_path / 'bin' / '../lib' /
+                                       'libfoo.so.1')
+
+
+def test_find_library_runpath_disables_rpath(tmp_path, monkeypatch):
+    write_elf64(tmp_path / 'app', needed=['libfoo.so.1'],
+                rpath=str(tmp_path / 'rpath'),
+                runpath=str(tmp_path / 'runpath'))
+    write_elf64(tmp_path / 'rpath' / 'libfoo.so.1')
+    write_elf64(tmp_path / 'runpath' / 'libfoo.so.1')
+    paths = run_app(tmp_path / 'app', monkeypatch)
+    assert paths['libfoo.so.1'] == str(tmp_path / 'runpath' / 'libfoo.so.1')
+
+
+def test_find_library_rpath_before_ld_library_path(tmp_path, monkeypatch):
+    write_elf64(tmp_path / 'app', needed=['libfoo.so.1'],
+                rpath=str(tmp_path / 'rpath'))
+    write_elf64(tmp_path / 'rpath' / 'libfoo.so.1')
+    write_elf64(tmp_path / 'env' / 'libfoo.so.1')
+    paths = run_app(tmp_path / 'app', monkeypatch,
+                    ld_library_path=str(tmp_path / 'env'))
+    assert paths['libfoo.so.1'] == str(tmp_path / 'rpath' / 'libfoo.so.1')
+
+
+def test_find_library_runpath_after_ld_library_path(tmp_path, monkeypatch):
+    write_elf64(tmp_path / 'app', needed=['libfoo.so.1'],
+                runpath=str(tmp_path / 'runpath'))
+    write_elf64(tmp_path / 'runpath' / 'libfoo.so.1')
+    write_elf64(tmp_path / 'env' / 'libfoo.so.1')
+    paths = run_app(tmp_path / 'app', monkeypatch,
+                    ld_library_path=str(tmp_path / 'env'))
+    assert paths['libfoo.so.1'] == str(tmp_path / 'env' / 'libfoo.so.1')
+
+
+def test_find_library_uses_executable_rpath(tmp_path, monkeypatch):
+    # libfoo has no DT_RPATH nor DT_RUNPATH, so libbar is looked up in the
+    # DT_RPATH of the executable
+    write_elf64(tmp_path / 'app', needed=['libfoo.so.1'],
+                rpath=str(tmp_path / 'lib'))
+    write_elf64(tmp_path / 'lib' / 'libfoo.so.1', needed=['libbar.so.1'])
+    write_elf64(tmp_path / 'lib' / 'libbar.so.1')
+    paths = run_app(tmp_path / 'app', monkeypatch)
+    assert paths['libbar.so.1'] == str(tmp_path / 'lib' / 'libbar.so.1')
+
+
+def test_find_library_skips_non_elf_files(tmp_path, monkeypatch):
+    write_elf64(tmp_path / 'app', needed=['libfoo.so.1'],
+                rpath='{0}/a:{0}/b:{0}/c'.format(tmp_path))
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'libfoo.so.1').write_text('INPUT(libfoo.so.2)')
+    # Truncated ELF header
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'b' / 'libfoo.so.1').write_bytes(b'\x7fELF')
+    write_elf64(tmp_path / 'c' / 'libfoo.so.1')
+    paths = run_app(tmp_path / 'app', monkeypatch)
+    assert paths['libfoo.so.1'] == str(tmp_path / 'c' / 'libfoo.so.1')
+
+
+@pytest.mark.parametrize('error', [
+    OSError(errno.ENOENT, 'No such file or directory'),
+    subprocess.CalledProcessError(1, ['ldconfig', '-p']),
+])
+def test_find_library_without_ldconfig_cache(tmp_path, monkeypatch, error):
+    def check_output(*args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(subprocess, 'check_output', check_output)
+    monkeypatch.setattr(copydeps, 'DEFAULT_LIBRARY_DIRS',
+                        [str(tmp_path / 'lib')])
+    monkeypatch.setenv('LD_LIBRARY_PATH', '')
+    write_elf64(tmp_path / 'app', needed=['libfoo.so.1'])
+    write_elf64(tmp_path / 'lib' / 'libfoo.so.1')
+    app = App(exclude_list=[], destdir=str(tmp_path), dry_run=True)
+    app.run(str(tmp_path / 'app'), 'app')
+    assert app.ldcache == {}
+    assert app.path_for_binary['libfoo.so.1'] == str(tmp_path / 'lib' /
+                                                     'libfoo.so.1')
+
+
+def test_missing_libraries(tmp_path, monkeypatch):
+    write_elf64(tmp_path / 'app',
+                needed=['libfoo.so.1', 'libmissing.so.1', 'libother.so.2'],
+                runpath=str(tmp_path / 'lib'))
+    write_elf64(tmp_path / 'lib' / 'libfoo.so.1')
     with pytest.raises(MissingLibrariesError) as excinfo:
-        parse_ldd_output(LDD_OUTPUT)
-    assert excinfo.value.libs == ['libstdc++.so.5', 'libbar.so.2']
+        run_app(tmp_path / 'app', monkeypatch)
+    assert excinfo.value.libs == ['libmissing.so.1', 'libother.so.2']
+
+
+def create_symlinked_library(tmp_path):
+    """Create libfoo.so.1 -> libfoo.so.1.2.3 in tmp_path/src. Return the
+    paths of the symlink and of its target"""
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    target = src_dir / 'libfoo.so.1.2.3'
+    target.write_bytes(b'library content')
+    target.chmod(0o755)
+    link = src_dir / 'libfoo.so.1'
+    link.symlink_to('libfoo.so.1.2.3')
+    (tmp_path / 'dst').mkdir()
+    return link, target
+
+
+def test_copy_file(tmp_path):
+    link, target = create_symlinked_library(tmp_path)
+    dst = tmp_path / 'dst' / 'libfoo.so.1'
+    copy_file(str(link), str(dst))
+    assert dst.read_bytes() == b'library content'
+
+
+def test_copy_file_without_copy_file_range(tmp_path, monkeypatch):
+    def copy_file_range(*args):
+        raise OSError(errno.ENOSYS, 'Function not implemented')
+
+    monkeypatch.setattr(os, 'copy_file_range', copy_file_range,
+                        raising=False)
+    link, target = create_symlinked_library(tmp_path)
+    dst = tmp_path / 'dst' / 'libfoo.so.1'
+    copy_file(str(link), str(dst))
+    assert dst.read_bytes() == b'library content'
+
+
+def test_copy(tmp_path):
+    link, target = create_symlinked_library(tmp_path)
+    dst = tmp_path / 'dst' / 'libfoo.so.1'
+    copy(str(link), str(dst))
+    assert not dst.is_symlink()
+    assert dst.read_bytes() == b'library content'
+    assert dst.stat().st_mode == target.stat().st_mode
+    assert dst.stat().st_ino != target.stat().st_ino
+
+
+def test_copy_hardlink(tmp_path):
+    link, target = create_symlinked_library(tmp_path)
+    dst = tmp_path / 'dst' / 'libfoo.so.1'
+    copy(str(link), str(dst), hardlink=True)
+    assert not dst.is_symlink()
+    assert dst.is_file()
+    assert dst.stat().st_ino == target.stat().st_ino
+
+
+def test_copy_hardlink_cross_device(tmp_path, monkeypatch):
+    def link(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(os, 'link', link)
+    link_path, target = create_symlinked_library(tmp_path)
+    dst = tmp_path / 'dst' / 'libfoo.so.1'
+    copy(str(link_path), str(dst), hardlink=True)
+    assert not dst.is_symlink()
+    assert dst.read_bytes() == b'library content'
+    assert dst.stat().st_ino != target.stat().st_ino